@@ -1,6 +1,10 @@
+import asyncio
+import logging
 import os
 import shutil
 import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -15,6 +19,9 @@ from telegram.ext import (
 )
 from loguru import logger
 
+import import_1C
+import import_Bitrix
+import import_invoice
 from import_1C import run_pipeline as run_1c_pipeline
 from import_Bitrix import run_pipeline as run_bitrix_pipeline
 from import_invoice import run_pipeline as run_invoice_pipeline
@@ -22,10 +29,50 @@ from import_invoice import run_pipeline as run_invoice_pipeline
 # Загрузка переменных окружения
 load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 
-# Логирование
-logger.remove()
-logger.add("bot_logs.log", rotation="10 MB", level="DEBUG")
+
+class InterceptHandler(logging.Handler):
+    """Перенаправляет записи стандартного logging (telegram, httpx) в loguru."""
+
+    def emit(self, record):
+        try:
+            level = logger.level(record.levelname).name
+        except ValueError:
+            level = record.levelno
+
+        frame, depth = logging.currentframe(), 2
+        while frame and frame.f_code.co_filename == logging.__file__:
+            frame = frame.f_back
+            depth += 1
+
+        logger.opt(depth=depth, exception=record.exc_info).log(level, record.getMessage())
+
+
+def setup_logging():
+    """Настраивает логирование бота; вызывается только из main()."""
+    logger.remove()
+    logger.add("bot_logs.log", rotation="10 MB", level=LOG_LEVEL, enqueue=True, backtrace=False, diagnose=False)
+
+    # Из библиотек пишем только WARNING и выше: httpx логирует каждый запрос к API
+    logging.basicConfig(handlers=[InterceptHandler()], level=logging.WARNING, force=True)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("telegram.ext._application").setLevel(logging.WARNING)
+
+
+# Пул процессов для тяжёлых pandas/openpyxl пайплайнов создаётся в main():
+# под spawn (Windows) воркеры заново импортируют этот модуль
+EXECUTOR = None
+
+
+def _init_worker(bot_logger):
+    """Подключает пайплайны в воркере пула к синкам бота.
+    Под spawn воркер импортирует модули заново и без этого пишет только в stderr;
+    синк bot_logs.log с enqueue=True передаёт записи в очередь основного процесса."""
+    import_1C.logger = import_Bitrix.logger = import_invoice.logger = bot_logger
+
+# Одновременных скачиваний из Telegram не больше DOWNLOAD_SEM (пачки PDF качаются параллельно)
+DOWNLOAD_SEM = asyncio.Semaphore(4)
 
 # Состояния
 UPLOAD_REGISTRY, MENU, UPLOAD_FILE = range(3)
@@ -38,9 +85,10 @@ reply_keyboard = [
     ['Выгрузить реестр АХЧ'],
     ['Отмена']
 ]
+markup_main = ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True)
 
-# Клавиатура для завершения загрузки
-done_keyboard = [['/done']]
+# Клавиатура для завершения загрузки PDF
+done_keyboard = [['Готово']]
 markup_done = ReplyKeyboardMarkup(done_keyboard, resize_keyboard=True)
 
 
@@ -50,6 +98,9 @@ SINGLE_FILE_ACTIONS = {
     'Загрузить отчёт из Bitrix'
 }
 
+# Подтверждения о загрузке PDF отправляем не чаще, чем раз в PDF_ACK_INTERVAL секунд
+PDF_ACK_INTERVAL = 2.0
+
 # Меняем prompts — не нужно упоминать /done для Excel
 prompts = {
     'Загрузить выписку из 1С': "Отправь Excel-файл с выпиской из 1С.",
@@ -58,10 +109,6 @@ prompts = {
 }
 
 
-# Хранилище данных пользователей
-user_data = {}
-
-
 # =================== ОСНОВНЫЕ ФУНКЦИИ ===================
 
 async def start(update, context: ContextTypes.DEFAULT_TYPE):
@@ -75,25 +122,29 @@ async def start(update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def registry_received(update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
     file = update.message.document
 
     if not file or not file.file_name.lower().endswith('.xlsx'):
         await update.message.reply_text("Пожалуйста, загрузи корректный Excel-файл (.xlsx).")
         return UPLOAD_REGISTRY
 
+    # Повторная загрузка реестра — удаляем файлы предыдущей сессии
+    await _cancel_pending_downloads(context)
+    old_temp_dir = context.user_data.pop('temp_dir', None)
+    if old_temp_dir:
+        shutil.rmtree(old_temp_dir, ignore_errors=True)
+    context.user_data.clear()
+
     temp_dir = Path(tempfile.mkdtemp())
-    user_data[user_id] = {'temp_dir': temp_dir}
+    context.user_data['temp_dir'] = temp_dir
 
 
-    new_file = await file.get_file()
     file_path = temp_dir / file.file_name
-    await new_file.download_to_drive(file_path)
+    await _save_upload(file, file_path)
     logger.info(f"Файл реестра загружен: {file_path}")
 
 
-    markup = ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=False, resize_keyboard=True)
-    await update.message.reply_text("Выберите действие:", reply_markup=markup)
+    await update.message.reply_text("Выберите действие:", reply_markup=markup_main)
     return MENU
 
 
@@ -103,7 +154,7 @@ async def menu_choice(update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Пользователь {user_id} выбрал: {choice}")
 
     if choice in prompts:
-        user_data[user_id]['current_action'] = choice
+        context.user_data['current_action'] = choice
 
         # Если это одиночный файл (Excel), не показываем "Готово"
         if choice in SINGLE_FILE_ACTIONS:
@@ -111,12 +162,11 @@ async def menu_choice(update, context: ContextTypes.DEFAULT_TYPE):
             return UPLOAD_FILE
         else:
             # Для PDF — показываем кнопку "Готово"
-            markup = ReplyKeyboardMarkup([['Готово']], resize_keyboard=True)
-            await update.message.reply_text(prompts[choice], reply_markup=markup)
+            await update.message.reply_text(prompts[choice], reply_markup=markup_done)
             return UPLOAD_FILE
 
     elif choice == 'Выгрузить реестр АХЧ':
-        temp_dir = user_data[user_id]['temp_dir']
+        temp_dir = context.user_data['temp_dir']
         registry_files = list(temp_dir.glob("*реестр*ахч*.xlsx")) or \
                          list(temp_dir.glob("*АХЧ*.xlsx")) or \
                          list(temp_dir.glob("*Реестр*.xlsx")) or \
@@ -124,11 +174,12 @@ async def menu_choice(update, context: ContextTypes.DEFAULT_TYPE):
 
         if registry_files:
             registry_path = registry_files[0]
-            await update.message.reply_document(document=open(registry_path, 'rb'))
+            with open(registry_path, 'rb') as f:
+                await update.message.reply_document(document=f)
         else:
             await update.message.reply_text("Реестр не найден.")
 
-        await cleanup(user_id)
+        await cleanup(update, context)
         await start(update, context)
         return UPLOAD_REGISTRY
 
@@ -145,9 +196,8 @@ async def menu_choice(update, context: ContextTypes.DEFAULT_TYPE):
 # =============== НОВЫЙ: ОБРАБОТЧИК ФАЙЛОВ (ТОЛЬКО СБОР) ===============
 
 async def file_received(update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    action = user_data[user_id]['current_action']
-    temp_dir = user_data[user_id]['temp_dir']
+    action = context.user_data['current_action']
+    temp_dir = context.user_data['temp_dir']
 
     if not update.message.document:
         await update.message.reply_text("Пожалуйста, отправьте файл как документ.")
@@ -175,10 +225,17 @@ async def file_received(update, context: ContextTypes.DEFAULT_TYPE):
         file_path = temp_dir / f"{stem}_{counter}{suffix}"
         counter += 1
 
+    # 🔹 PDF скачиваем в фоне, чтобы пользователь мог сразу отправлять следующие
+    if action not in SINGLE_FILE_ACTIONS:
+        file_path.touch()  # резервируем имя для следующих файлов
+        # Задачу отслеживает PTB (дожидается при остановке), отменяется при очистке сессии
+        task = context.application.create_task(_download_pdf(update, context, file, file_path), update=update)
+        context.user_data.setdefault('pending_tasks', []).append(task)
+        return UPLOAD_FILE
+
     # Скачиваем
     try:
-        new_file = await file.get_file()
-        await new_file.download_to_drive(file_path)
+        await _save_upload(file, file_path)
         logger.info(f"Файл загружен: {file_path}")
         await update.message.reply_text(f"Файл '{file_path.name}' успешно загружён.")
     except Exception as e:
@@ -187,45 +244,46 @@ async def file_received(update, context: ContextTypes.DEFAULT_TYPE):
         return UPLOAD_FILE
 
     # 🔹 Автозапуск для Excel (1С и Bitrix)
-    if action in SINGLE_FILE_ACTIONS:
-        try:
-            if action == 'Загрузить выписку из 1С':
-                run_1c_pipeline(str(temp_dir))
-            elif action == 'Загрузить отчёт из Bitrix':
-                run_bitrix_pipeline(str(temp_dir))
-
-            await update.message.reply_text(
-                "Файл успешно обработан.\nВыберите следующее действие:",
-                reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True)
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при выполнении pipeline: {e}", exc_info=True)
-            await update.message.reply_text(
-                "Произошла ошибка при обработке файла.",
-                reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True)
-            )
-
-        # Очищаем только current_action, temp_dir остаётся
-        del user_data[user_id]['current_action']
-        return MENU
+    try:
+        if action == 'Загрузить выписку из 1С':
+            await run_in_executor(run_1c_pipeline, str(temp_dir))
+        elif action == 'Загрузить отчёт из Bitrix':
+            await run_in_executor(run_bitrix_pipeline, str(temp_dir))
 
-    # 🔹 Для PDF — остаёмся в UPLOAD_FILE, ждём "Готово"
-    return UPLOAD_FILE
+        await update.message.reply_text(
+            "Файл успешно обработан.\nВыберите следующее действие:",
+            reply_markup=markup_main
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении pipeline: {e}", exc_info=True)
+        await update.message.reply_text(
+            "Произошла ошибка при обработке файла.",
+            reply_markup=markup_main
+        )
+
+    # Очищаем только current_action, temp_dir остаётся
+    del context.user_data['current_action']
+    return MENU
 
 
 # =============== НОВАЯ КОМАНДА: /done ===============
 
 async def done_command(update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    if user_id not in user_data or 'current_action' not in user_data[user_id]:
+    if 'current_action' not in context.user_data:
         await update.message.reply_text(
             "Нет активной загрузки.",
-            reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True)
+            reply_markup=markup_main
         )
         return MENU
 
-    action = user_data[user_id]['current_action']
-    temp_dir = user_data[user_id]['temp_dir']
+    action = context.user_data['current_action']
+    temp_dir = context.user_data['temp_dir']
+
+    # Дожидаемся PDF, которые ещё скачиваются в фоне
+    pending_tasks = context.user_data.pop('pending_tasks', [])
+    if pending_tasks:
+        await asyncio.gather(*pending_tasks)
+    context.user_data.pop('last_pdf_ack', None)
 
     files = list(temp_dir.glob("*.pdf"))
     if not files:
@@ -233,28 +291,76 @@ async def done_command(update, context: ContextTypes.DEFAULT_TYPE):
         return MENU
 
     try:
-        run_invoice_pipeline(str(temp_dir))
+        # Пайплайн уже в воркере пула бота — PDF разбираются в нём же, без вложенного пула
+        await run_in_executor(run_invoice_pipeline, str(temp_dir), 1)
         await update.message.reply_text(
             f"✅ Успешно обработано {len(files)} PDF-файлов.\nВыберите следующее действие:",
-            reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True)
+            reply_markup=markup_main
         )
     except Exception as e:
         logger.error(f"Ошибка при выполнении pipeline: {e}", exc_info=True)
         await update.message.reply_text(
             "❌ Ошибка при обработке файлов.",
-            reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True)
+            reply_markup=markup_main
         )
 
-    del user_data[user_id]['current_action']
+    del context.user_data['current_action']
     return MENU
 
 
+async def still_processing(update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("⏳ Файлы ещё обрабатываются, подождите.")
+
+
 # =============== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===============
 
+async def run_in_executor(func, *args):
+    """Запускает синхронный пайплайн в пуле процессов и ждёт результат.
+    Обработчики, которые его вызывают, зарегистрированы с block=False —
+    пока идёт пайплайн, бот обслуживает других пользователей."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(EXECUTOR, func, *args)
+
+
+async def _save_upload(file, dest: Path):
+    """Скачивает документ из Telegram и пишет его на диск, не блокируя event loop."""
+    async with DOWNLOAD_SEM:
+        new_file = await file.get_file()
+        data = await new_file.download_as_bytearray()
+    await asyncio.to_thread(dest.write_bytes, data)
+
+
+async def _download_pdf(update, context: ContextTypes.DEFAULT_TYPE, file, file_path: Path):
+    """Фоновая загрузка PDF: при ошибке убирает файл и сообщает пользователю."""
+    try:
+        await _save_upload(file, file_path)
+        logger.info(f"Файл загружен: {file_path}")
+
+        # Пачку PDF подтверждаем одним сообщением, а не ответом на каждый файл
+        now = time.monotonic()
+        if now - context.user_data.get('last_pdf_ack', 0.0) > PDF_ACK_INTERVAL:
+            context.user_data['last_pdf_ack'] = now
+            await update.message.reply_text("Файлы принимаются. Когда закончишь — нажми «Готово».")
+    except Exception as e:
+        file_path.unlink(missing_ok=True)
+        logger.error(f"Ошибка загрузки файла: {e}")
+        await update.message.reply_text(f"Ошибка при загрузке файла: {e}")
+
+
+async def _cancel_pending_downloads(context: ContextTypes.DEFAULT_TYPE):
+    """Отменяет фоновые загрузки PDF, чтобы они не писали в удаляемую папку."""
+    pending_tasks = context.user_data.pop('pending_tasks', [])
+    for task in pending_tasks:
+        task.cancel()
+    if pending_tasks:
+        await asyncio.gather(*pending_tasks, return_exceptions=True)
+
+
 async def send_logs_and_cleanup(update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
+    await _cancel_pending_downloads(context)
     log_file = "bot_logs.log"
-    temp_dir = user_data[user_id].get('temp_dir')
+    temp_dir = context.user_data.get('temp_dir')
 
     log_files = []
 
@@ -277,22 +383,27 @@ async def send_logs_and_cleanup(update, context: ContextTypes.DEFAULT_TYPE):
     if temp_dir and os.path.exists(temp_dir):
         shutil.rmtree(temp_dir, ignore_errors=True)
 
-    user_data.pop(user_id, None)
+    context.user_data.clear()
     logger.info(f"Пользователь {user_id} завершил сессию.")
 
 
-async def cleanup(user_id):
-    if user_id in user_data:
-        temp_dir = user_data[user_id]['temp_dir']
-        if temp_dir and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir, ignore_errors=True)
-        user_data.pop(user_id, None)
+async def cleanup(update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    await _cancel_pending_downloads(context)
+    temp_dir = context.user_data.pop('temp_dir', None)
+    if temp_dir:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    context.user_data.clear()
     logger.info(f"Данные пользователя {user_id} очищены.")
 
 
 # =================== ГЛАВНАЯ ФУНКЦИЯ ===================
 
 def main():
+    global EXECUTOR
+    setup_logging()
+    EXECUTOR = ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_worker, initargs=(logger,))
+
     app = ApplicationBuilder().token(TOKEN).build()
 
     conv_handler = ConversationHandler(
@@ -301,9 +412,14 @@ def main():
         UPLOAD_REGISTRY: [MessageHandler(filters.Document.ALL, registry_received)],
         MENU: [MessageHandler(filters.TEXT & ~filters.COMMAND, menu_choice)],
         UPLOAD_FILE: [
-            MessageHandler(filters.Document.ALL, file_received),
-            MessageHandler(filters.TEXT & filters.Regex("^Готово$"), done_command),  # Только для PDF
+            # PDF только сохраняются — быстро и по порядку; Excel запускает пайплайн
+            # в фоне (block=False), чтобы не задерживать обновления других пользователей
+            MessageHandler(filters.Document.FileExtension("pdf"), file_received),
+            MessageHandler(filters.Document.ALL, file_received, block=False),
+            MessageHandler(filters.TEXT & filters.Regex("^Готово$"), done_command, block=False),  # Только для PDF
         ],
+        # Сообщения этого пользователя, пришедшие пока идёт обработка
+        ConversationHandler.WAITING: [MessageHandler(filters.ALL, still_processing)],
     },
     fallbacks=[
         CommandHandler('start', start),
@@ -317,6 +433,7 @@ def main():
     app.add_handler(conv_handler)
     logger.info("Бот запущен.")
     app.run_polling()
+    EXECUTOR.shutdown()
 
 
 if __name__ == '__main__':
@@ -9,25 +9,37 @@
 
 import pandas as pd
 import re
+from copy import copy
 from pathlib import Path
 from loguru import logger
 from openpyxl import load_workbook
 from openpyxl.utils.dataframe import dataframe_to_rows
-from openpyxl.cell import MergedCell
 
+# Быстрый Rust-движок для чтения Excel, если установлен python-calamine
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_ENGINE = None
 
-# Настройка логирования
-logger.remove()
-logger.add("1C_import.log", rotation="10 MB", level="INFO", encoding="utf-8")
-logger.add(lambda msg: print(msg, end=''), level="INFO")
 
+def setup_logging():
+    """Настраивает логирование (в файл и в stdout). Вызывать только при запуске модуля как скрипта:
+    при импорте из бота и в воркерах пула записи идут в синки бота."""
+    logger.remove()
+    logger.add("1C_import.log", rotation="10 MB", level="INFO", encoding="utf-8", enqueue=True)
+    logger.add(lambda msg: print(msg, end=''), level="INFO", enqueue=True)
 
 
-def load_ahx_data(directory_path):
+def _scan_excels(directory_path):
+    """Возвращает список Excel-файлов в директории (одно сканирование на пайплайн)."""
+    return list(Path(directory_path).glob('*.xls*'))
+
+
+def load_ahx_data(directory_path, excel_files=None):
     """Загружает реестр из Excel (начиная с 4 строки)."""
     try:
-        directory =  Path(directory_path)
-        all_excel_files = list(directory.glob('*.xls*'))
+        all_excel_files = excel_files if excel_files is not None else _scan_excels(directory_path)
         excel_files_AXCH = [
             f for f in all_excel_files 
             if 'ахч' in f.name.lower()
@@ -37,7 +49,7 @@ def load_ahx_data(directory_path):
         
         ahch_file_path = excel_files_AXCH[0]
         
-        df_register = pd.read_excel(ahch_file_path, skiprows=3)
+        df_register = pd.read_excel(ahch_file_path, skiprows=3, engine=EXCEL_ENGINE)
         logger.info(f"📊 Загружено {len(df_register)} записей из реестра.")
         return df_register, ahch_file_path
     
@@ -45,16 +57,16 @@ def load_ahx_data(directory_path):
         logger.error(f"[Ошибка загрузки Excel] {e}")
         return None
 
-def load_payment_data(directory_path):
+def load_payment_data(directory_path, excel_files=None):
     """Загружает выписку из 1С."""
     try:
-        directory = Path(directory_path)
-        excel_files_payment = list(directory.glob('*Платежн*.xls*'))
+        all_excel_files = excel_files if excel_files is not None else _scan_excels(directory_path)
+        excel_files_payment = [f for f in all_excel_files if 'платежн' in f.name.lower()]
 
         if not excel_files_payment:
             raise FileNotFoundError("❌ Файл выписки из 1С не найден.")
 
-        df_export_1C = pd.read_excel(excel_files_payment[0], skiprows=4)
+        df_export_1C = pd.read_excel(excel_files_payment[0], skiprows=4, engine=EXCEL_ENGINE)
         logger.info(f"📊 Загружено {len(df_export_1C)} записей из реестра.")
         return df_export_1C
     
@@ -63,59 +75,58 @@ def load_payment_data(directory_path):
         return None
 
 
-def extract_invoice_number(text):
-    """Извлекает номер документа из текста (счёт, накладная и т.д.)."""
-    if not isinstance(text, str):
-        return None
-
-    invoice_chars = r"[\w\-_+\/A-Za-zА-Яа-яЁё]"
-
-    # 1. Ищем после ключевых слов: "счет", "накладная" и т.д.
-    main_pattern = rf"""
-        (?:счет[ау]?|фактур[еа]|накладн[оийя]|товарн[аы][йя]|тмт|с\/?ф|[сc]\/?ф|тов\.?\s*накладн[оийя])
-        \b                      # граница слова
-        \W*                     # разделители
-        ({invoice_chars}*?\d{invoice_chars}*)  # номер с цифрой
-    """
-    match = re.search(main_pattern, text, re.IGNORECASE | re.DOTALL | re.VERBOSE)
-    if match:
-        return match.group(1).strip()
+_INVOICE_CHARS = r"[\w\-_+\/A-Za-zА-Яа-яЁё]"
 
-    # 2. Ищем после символа №
-    alt_match = re.search(r"№\s*([A-Za-zА-Яа-яЁё\d\-_+\/]+)", text, re.IGNORECASE)
-    if alt_match:
-        return alt_match.group(1).strip()
+# 1. Номер после ключевых слов: "счет", "накладная" и т.д.
+_MAIN_RE = re.compile(rf"""
+    (?:счет[ау]?|фактур[еа]|накладн[оийя]|товарн[аы][йя]|тмт|с\/?ф|[сc]\/?ф|тов\.?\s*накладн[оийя])
+    \b                      # граница слова
+    \W*                     # разделители
+    ({_INVOICE_CHARS}{{0,40}}?\d{_INVOICE_CHARS}{{0,40}})  # номер с цифрой (длина ограничена против бэктрекинга)
+""", re.IGNORECASE | re.DOTALL | re.VERBOSE)
+# 2. Номер после символа №
+_ALT_RE = re.compile(r"№\s*([A-Za-zА-Яа-яЁё\d\-_+\/]+)", re.IGNORECASE)
+# 3. Первое число в тексте
+_NUM_RE = re.compile(r"\b(\d+)\b")
 
-    # 3. Берём первое число
-    fallback_match = re.search(r"\b\d+\b", text)
-    if fallback_match:
-        return fallback_match.group(0).strip()
-
-    logger.debug("Номер документа не найден.")
-    return None
 
 def prepare_register(df_register):
-    """Подготавливает реестр: убирает ведущие нули, приводит типы."""
+    """Подготавливает реестр: убирает ведущие нули, приводит типы.
+    Единственная защитная копия пайплайна — дальше этапы меняют кадр на месте."""
     logger.info("Преобразование типов данных реест АХЧ")
     df_register = df_register.copy()
     df_register['№ счета'] = df_register['№ счета'].fillna('').astype("string")
     df_register['Сумма'] = pd.to_numeric(df_register['Сумма'], errors='coerce').round(2)
-    df_register['№ задачи Битрикс'] = pd.to_numeric(df_register['№ задачи Битрикс'], errors='coerce').astype(dtype = int, errors = 'ignore')
-    df_register['ID_Счет_Bitrix'] = pd.to_numeric(df_register['ID_Счет_Bitrix'], errors='coerce').astype(dtype = int, errors = 'ignore')
+    # Целые ID сужаются до минимального int; при пропусках остаётся float64.
+    # Сумма остаётся float64: float32 ломает сравнение ключей с выгрузками
+    df_register['№ задачи Битрикс'] = pd.to_numeric(df_register['№ задачи Битрикс'], errors='coerce', downcast='integer')
+    df_register['ID_Счет_Bitrix'] = pd.to_numeric(df_register['ID_Счет_Bitrix'], errors='coerce', downcast='integer')
+    # Статусов и поставщиков немного — категориальный тип хранит коды, а не строки
+    df_register['Статус оплаты'] = df_register['Статус оплаты'].astype('category')
+    df_register['Поставщик'] = df_register['Поставщик'].astype('category')
 
     logger.info("✅ Данные подготовлены.")
     return df_register
 
 
 def prepare_export_1C(df_export_1C):
-    """Подготавливает данные: убирает ведущие нули, приводит типы."""
+    """Подготавливает данные: убирает ведущие нули, приводит типы (на месте)."""
     
     logger.info("Преобразование типов данных реестра 1C")
-    df_export_1C = df_export_1C.copy()
-    # Извлекаем номера счетов из "Информация"
-    df_export_1C['Номер счета'] = df_export_1C['Информация'].apply(extract_invoice_number)
-    df_export_1C['Номер счета'] = df_export_1C['Номер счета'].astype(str).apply(
-        lambda x: str(int(x)) if x.isdigit() else x
+    # Извлекаем номера счетов из "Информация".
+    # Тексты платежей часто повторяются, поэтому regex гоняем только по уникальным
+    codes, uniques = pd.factorize(df_export_1C['Информация'].astype("string"))
+    info = pd.Series(uniques, dtype="string")
+    nums = (
+        info.str.extract(_MAIN_RE, expand=False)
+        .fillna(info.str.extract(_ALT_RE, expand=False))
+        .fillna(info.str.extract(_NUM_RE, expand=False))
+    )
+    # Убираем ведущие нули у чисто цифровых номеров
+    is_digits = nums.str.fullmatch(r'\d+', na=False)
+    nums = nums.mask(is_digits, nums.str.lstrip('0').replace('', '0'))
+    df_export_1C['Номер счета'] = pd.Series(
+        nums.array.take(codes, allow_fill=True), index=df_export_1C.index
     )
 
     # Приводим суммы к числу
@@ -126,26 +137,20 @@ def prepare_export_1C(df_export_1C):
 
 
 def update_payment_status(df_export, df_register):
-    """Обновляет статус оплаты на основе совпадения по № счёта и сумме."""
+    """Обновляет статус оплаты на основе совпадения по № счёта и сумме (на месте)."""
     try:
         # Убираем дубликаты в выписке
         df_export_unique = df_export.drop_duplicates(subset=['Номер счета', 'Сумма'])
-        df_export_mapped = df_export_unique[['Номер счета', 'Сумма', 'Состояние']].copy()
-        df_export_mapped.columns = ['№ счета', 'Сумма', 'Статус оплаты']
+        status_lookup = df_export_unique.set_index(['Номер счета', 'Сумма'])['Состояние']
 
-        # Объединяем
-        df_merged = df_register.merge(
-            df_export_mapped,
-            on=['№ счета', 'Сумма'],
-            how='left',
-            suffixes=('', '_новый')
-        )
+        # Ищем новый статус по ключу без сборки объединённого кадра из всего реестра
+        keys = pd.MultiIndex.from_frame(df_register[['№ счета', 'Сумма']])
+        new_status = pd.Series(status_lookup.reindex(keys).to_numpy(), index=df_register.index)
 
         # Обновляем только пустые или неокончательные статусы
-        mask = df_merged['Статус оплаты_новый'].notna() & \
+        mask = new_status.notna() & \
                (~df_register['Статус оплаты'].isin(["Оплачено", "Подготовлено"]))
-        df_register = df_register.copy()
-        df_register.loc[mask, 'Статус оплаты'] = df_merged.loc[mask, 'Статус оплаты_новый']
+        df_register['Статус оплаты'] = new_status.where(mask, df_register['Статус оплаты'])
 
         updated_count = mask.sum()
         if updated_count > 0:
@@ -160,6 +165,7 @@ def update_payment_status(df_export, df_register):
 
 
 def update_date_payment(df_register):
+    """Заполняет 'Контроль оплаты' по дате счета и отсрочке поставщика (на месте)."""
     # Словарь с количеством дней для каждого поставщика
     days_dict = {
         'ип шайдулин': 30,
@@ -171,46 +177,31 @@ def update_date_payment(df_register):
         'ип павлов е.в.': 0
     }
     
-    # Создаем копию датафрейма для безопасной работы
-    df_result = df_register.copy()
-    
+    df_result = df_register
+
     # Инициализируем счетчик обновленных записей
     updated_count = 0
-    
+
     try:
         # Преобразуем колонку 'Дата счета' в datetime с указанием формата
         df_result['Дата счета'] = pd.to_datetime(df_result['Дата счета'], errors='coerce', format='%d.%m.%Y', dayfirst=True)
-        
-        # Создаем или очищаем колонку 'Контроль оплаты' если она не существует
-        if 'Контроль оплаты' not in df_result.columns:
-            df_result['Контроль оплаты'] = None
-        
-        # Проходим по каждой строке датафрейма
-        for index, row in df_result.iterrows():
-            try:
-                # Проверяем, что дата счета не пустая
-                if pd.notna(row['Дата счета']):
-                    # Получаем поставщика и приводим к нижнему регистру
-                    supplier = str(row['Поставщик']).lower().strip()
-                    
-                    # Получаем количество дней из словаря
-                    days_to_add = days_dict.get(supplier, 0)
-                    
-                    # Добавляем дни к дате счета
-                    new_date = row['Дата счета'] + pd.Timedelta(days=days_to_add)
-                    # Записываем в колонку 'Контроль оплаты'
-                    df_result.at[index, 'Контроль оплаты'] = new_date
-                    # Увеличиваем счетчик обновлений
-                    updated_count += 1
-                    
-            except Exception as e:
-                logger.error(f"Ошибка при обработке строки {index}: {e}")
-                continue
-        
-        # Преобразуем колонку 'Контроль оплаты' в строковый формат
-        if 'Контроль оплаты' in df_result.columns and not df_result['Контроль оплаты'].empty:
-            df_result['Контроль оплаты'] = pd.to_datetime(df_result['Контроль оплаты'], errors='coerce').dt.strftime('%d.%m.%Y')
-        
+
+        # Количество дней для каждой строки по поставщику (неизвестные — 0)
+        # Категории: словарь применяется один раз на уникального поставщика
+        suppliers = df_result['Поставщик'].astype('category')
+        days = suppliers.map(lambda s: days_dict.get(str(s).lower().strip(), 0)).fillna(0).astype('int16')
+
+        # Добавляем дни к дате счета сразу для всей колонки
+        control_dates = df_result['Дата счета'] + pd.to_timedelta(days, unit='D')
+        updated_count = control_dates.notna().sum()
+
+        # Строки без даты счета сохраняют прежнее значение 'Контроль оплаты'.
+        # Колонка остаётся datetime64 — в строку её переводит update_excel_file
+        if 'Контроль оплаты' in df_result.columns:
+            previous = pd.to_datetime(df_result['Контроль оплаты'], errors='coerce', format='%d.%m.%Y')
+            control_dates = control_dates.fillna(previous)
+        df_result['Контроль оплаты'] = control_dates
+
         # Логируем результат
         logger.info(f"✅ Обновлено {updated_count} дат контроля оплаты.")
         
@@ -222,11 +213,13 @@ def update_date_payment(df_register):
 
 
 def update_excel_file(file_path, df):
-    """Сохраняет DataFrame в Excel с сохранением форматирования."""
+    """Сохраняет DataFrame в Excel с сохранением форматирования шапки и строк данных.
+    Колонки дат в df переводятся в строки на месте."""
     try:
-        df_save = df.copy()
+        df_save = df
 
-        # приводим формат дат к EXCEL
+        # приводим формат дат к EXCEL: datetime64 форматируется один раз здесь,
+        # разбор строк нужен только для смешанных колонок (реестр + новые счета)
         date_columns = ['Контроль оплаты', 'Дата счета']
         for col in date_columns:
             if col in df_save.columns:
@@ -249,17 +242,26 @@ def update_excel_file(file_path, df):
         wb = load_workbook(file_path)
         ws = wb.active
 
-        for row in ws.iter_rows(min_row=4):
-            for cell in row:
-                if not isinstance(cell, MergedCell):
-                    cell.value = None
+        # Шапка (строки 1-3) и строка заголовков (4-я) со своими стилями остаются,
+        # строки данных с 5-й пишем заново
+        for merged in list(ws.merged_cells.ranges):
+            if merged.max_row >= 5:
+                ws.unmerge_cells(str(merged))
+        # Стили первой строки данных (шрифт, границы, числовые форматы) переносятся на новые строки
+        row_styles = [copy(cell._style) for cell in ws[5]] if ws.max_row >= 5 else []
+        if ws.max_row >= 5:
+            ws.delete_rows(5, ws.max_row - 4)
 
         for col_idx, col_name in enumerate(df_save.columns, 1):
-            ws.cell(row=4, column=col_idx, value=col_name)
+            ws.cell(row=4, column=col_idx).value = col_name
+
+        for row in dataframe_to_rows(df_save, index=False, header=False):
+            ws.append(row)
 
-        for row_idx, row in enumerate(dataframe_to_rows(df_save, index=False, header=False), 5):
-            for col_idx, value in enumerate(row, 1):
-                ws.cell(row=row_idx, column=col_idx, value=value)
+        if row_styles:
+            for row in ws.iter_rows(min_row=5, max_col=len(row_styles)):
+                for cell, style in zip(row, row_styles):
+                    cell._style = copy(style)
 
         wb.save(file_path)
         logger.info(f"💾 Реестр обновлён: {file_path}")
@@ -278,8 +280,9 @@ def run_pipeline(directory_path: str) -> str:
         logger.info("🔹 Запуск пайплайна: обработка выписки из 1С")
 
         # Шаг 1: Загрузка файлов
-        df_register, ahch_path = load_ahx_data(directory_path)
-        df_export_1C = load_payment_data(directory_path)
+        excel_files = _scan_excels(directory_path)
+        df_register, ahch_path = load_ahx_data(directory_path, excel_files)
+        df_export_1C = load_payment_data(directory_path, excel_files)
 
         # Шаг 2: Подготовка данных
         df_export_clean = prepare_export_1C(df_export_1C)
@@ -303,6 +306,7 @@ def run_pipeline(directory_path: str) -> str:
 
 # --- Для теста ---
 if __name__ == "__main__":
+    setup_logging()
     test_path = r"C:\Users\Юрий Кистенев\Desktop\ACH_manager\record"
     result = run_pipeline(test_path)
     print(result)
\ No newline at end of file
@@ -9,6 +9,7 @@
 
 import re
 import pandas as pd
+from operator import itemgetter
 from pathlib import Path
 from openpyxl import load_workbook
 from openpyxl.utils.dataframe import dataframe_to_rows
@@ -18,8 +19,27 @@ from import_1C import update_excel_file as update_excel_file
 from import_1C import load_ahx_data as load_ahx_data
 from import_1C import prepare_register as prepare_register
 from import_1C import update_date_payment as update_date_payment
+from import_1C import EXCEL_ENGINE as EXCEL_ENGINE
 
 
+# Стоп-слова, которые убираются из описания ТМЦ (как отдельные слова)
+STOP_WORDS = ['cчет', 'расходы', 'cчета', 'расходов', 'ахч']
+_STOP_WORDS_RE = re.compile(r'\b(?:' + '|'.join(re.escape(word.lower()) for word in STOP_WORDS) + r')\b')
+_SPACES_RE = re.compile(r'\s+')
+
+# Столбцы выгрузки Bitrix, которые нужны пайплайну. Первые три (ID, ТМЦ, получатель)
+# берутся по позиции — их заголовки в выгрузке не фиксированы
+BITRIX_POSITIONAL_COLUMNS = 3
+BITRIX_COLUMNS = ['Объект', 'Номер счета', 'Сумма', 'Дата счета', 'Статус Счета', 'Ссылка на задачу']
+
+
+def _bitrix_positions(header):
+    """Возвращает номера нужных столбцов выгрузки Bitrix по строке заголовков."""
+    return [
+        i for i, name in enumerate(header)
+        if i < BITRIX_POSITIONAL_COLUMNS or name in BITRIX_COLUMNS
+    ]
+
 
 def load_bitrix(directory_path: str):
     """Загружает df_bitrix из указанной директории."""
@@ -33,33 +53,43 @@ def load_bitrix(directory_path: str):
     
     logger.info(f"Найден файл Bitrix: {excel_files_bitrix[0].name}")
 
-    dtypes = {
-#        'ID': str,
-        'Номер счета': str,
-        'Сумма': str,
-        'Дата счета': 'datetime64[ns]',
-        'Статус Счета': str,
-    }
-        # Чтение файла Bitrix
-    df_bitrix = pd.read_excel(
-        excel_files_bitrix[0],  # обычно первый файл — нужный
-#        names = columns,
-        dtype=dtypes,
-        engine='openpyxl'
-    )
+    str_columns = ['Номер счета', 'Сумма', 'Статус Счета']
+
+    # Чтение файла Bitrix: calamine (Rust), иначе openpyxl построчно (read_only).
+    # Остаются только нужные столбцы
+    bitrix_path = excel_files_bitrix[0]  # обычно первый файл — нужный
+    if EXCEL_ENGINE == 'calamine':
+        # dtype=str обязателен: иначе pandas превратит '0012' в 12.0.
+        # Лист читается один раз целиком: отдельное чтение заголовка у calamine грузит весь лист повторно
+        df_bitrix = pd.read_excel(
+            bitrix_path,
+            engine='calamine',
+            dtype={col: str for col in str_columns}
+        )
+        df_bitrix = df_bitrix.iloc[:, _bitrix_positions(df_bitrix.columns)]
+    else:
+        wb = load_workbook(bitrix_path, read_only=True, data_only=True)
+        try:
+            rows = wb.active.iter_rows(values_only=True)
+            header = next(rows, ())
+            pick = itemgetter(*_bitrix_positions(header))
+            # dtype=object, как dtype=str у calamine: иначе числовой столбец с пропусками
+            # станет float64 и номер 123 превратится в '123.0'
+            df_bitrix = pd.DataFrame(list(map(pick, rows)), columns=pick(header), dtype=object).dropna(how='all')
+            other_columns = df_bitrix.columns.difference(str_columns, sort=False)
+            df_bitrix[other_columns] = df_bitrix[other_columns].infer_objects()
+        finally:
+            wb.close()
+
+    for col in str_columns:
+        df_bitrix[col] = df_bitrix[col].where(df_bitrix[col].isna(), df_bitrix[col].astype(str))
+    # Ячейки-даты приходят готовыми, текстовые — в формате Bitrix дд.мм.гггг
+    df_bitrix['Дата счета'] = pd.to_datetime(df_bitrix['Дата счета'], format='%d.%m.%Y', errors='coerce', cache=True)
     
     logger.info(f"📊 Загружено {len(df_bitrix)} записей из реестра Bitrix.")
 
     return df_bitrix
 
-def extract_task_id(url: str) -> str:
-    """Извлекает ID задачи из ссылки"""
-    match = re.search(r'/view/(\d+)/?$', url)
-    if match:
-        return match.group(1)
-    return None
-
-
 def prepare_bitrix(df_bitrix):
     """Подготавливает данные: извлечение ID, приведение типов, замена статусов."""
     logger.info("Подготовка данных Bitrix")
@@ -78,16 +108,17 @@ def prepare_bitrix(df_bitrix):
         'Оплачен': 'Отправлен в 1С',
         'Передан в оплату': 'Утверждена'
     }
-    df_bitrix['Статус Счета'] = df_bitrix['Статус Счета'].replace(status_changes)
+    # map по словарю — один хэш-проход; прочие статусы остаются как были
+    df_bitrix['Статус Счета'] = df_bitrix['Статус Счета'].map(status_changes).fillna(df_bitrix['Статус Счета'])
 
      # Извлечение ID задачи из ссылки
     logger.info("Извлечение ID задач из ссылок")
     df_bitrix['ID task'] = (
-        df_bitrix.loc[df_bitrix['Ссылка на задачу'].notna(), 'Ссылка на задачу']
+        df_bitrix['Ссылка на задачу']
         .astype("string")
-        .apply(extract_task_id)
+        .str.extract(r'/view/(\d+)/?$', expand=False)
     )
-    df_bitrix['ID task'] = pd.to_numeric(df_bitrix['ID task'], errors='coerce').astype(dtype = int, errors = 'ignore')
+    df_bitrix['ID task'] = pd.to_numeric(df_bitrix['ID task'], errors='coerce', downcast='integer')
     df_bitrix['Номер счета'] = df_bitrix['Номер счета'].astype("string").str.lstrip('0')
     df_bitrix['Сумма'] = pd.to_numeric(df_bitrix['Сумма'], errors='coerce').round(2)
     df_bitrix.columns = ['ID'] + list(df_bitrix.columns[1:])
@@ -130,14 +161,14 @@ def fill_invoice_numbers_from_bitrix(df_register, df_bitrix):
         logger.error("В реестре отсутствует столбец '№ задачи Битрикс'")
         raise KeyError("❌ В реестре отсутствует столбец '№ задачи Битрикс'.")
 
-    df_bitrix_rize = df_bitrix[['№ задачи Битрикс', 'Сумма', '№ счета']].copy()
-    df_bitrix_deduplicated = df_bitrix_rize.drop_duplicates(subset=['№ задачи Битрикс', 'Сумма'])
-
+    # df_bitrix уже уникален по (№ задачи, Сумма) после preprocess_bitrix_data
+    # merge, а не join по индексу: join падает, если все ключи Bitrix пустые (NA)
     df_register = df_register.merge(
-        df_bitrix_deduplicated,
+        df_bitrix[['№ задачи Битрикс', 'Сумма', '№ счета']],
         on=['№ задачи Битрикс', 'Сумма'],
         how='left',
-        suffixes=('', '_bitrix')
+        suffixes=('', '_bitrix'),
+        validate='m:1'
     )
 
     df_register['№ счета'] = df_register['№ счета'].replace('', pd.NA)
@@ -156,23 +187,43 @@ def fill_invoice_numbers_from_bitrix(df_register, df_bitrix):
     return df_register
 
 
-def update_register_payment_status_bitrix(df_register, df_bitrix):
-    """Обновляет статус оплаты на основе данных из Bitrix."""
-    logger.info("Обновление статусов оплаты из Bitrix")
-    
-    df_bitrix_mapped = df_bitrix[['№ счета', 'Сумма', 'Новый статус']].copy()
+def lookup_bitrix_by_invoice(df_register, df_bitrix):
+    """Подтягивает к строкам реестра данные Bitrix по № счета и сумме.
+    Одно объединение на все последующие обновления; индекс совпадает с реестром."""
+    logger.info("Сопоставление реестра с Bitrix по № счета и сумме")
+
+    df_bitrix_mapped = df_bitrix[['№ счета', 'Сумма', 'Новый статус', 'ID', 'Object', 'Things', '№ задачи Битрикс']]
     df_bitrix_deduplicated = df_bitrix_mapped.drop_duplicates(subset=['№ счета', 'Сумма'])
 
-    df_merged = df_register.merge(
+    # Общий категориальный тип для ключа: хэш-join сравнивает коды, а не строки.
+    # Категории — объединение обеих сторон, чтобы номера реестра не превращались в NaN;
+    # приводятся только копии ключей, столбцы реестра не меняются
+    invoice_dtype = pd.CategoricalDtype(
+        pd.concat([df_register['№ счета'], df_bitrix_deduplicated['№ счета']]).dropna().unique()
+    )
+    df_register_keys = df_register[['№ счета', 'Сумма']].astype({'№ счета': invoice_dtype})
+    df_bitrix_deduplicated = df_bitrix_deduplicated.astype({'№ счета': invoice_dtype})
+
+    df_bitrix_lookup = df_register_keys.merge(
         df_bitrix_deduplicated,
         on=['№ счета', 'Сумма'],
         how='left',
-        suffixes=('', '_bitrix')
+        validate='m:1'
     )
+    # left merge m:1 сохраняет порядок и число строк — возвращаем индекс реестра
+    df_bitrix_lookup.index = df_register.index
+
+    return df_bitrix_lookup
+
+
+def update_register_payment_status_bitrix(df_register, df_bitrix_lookup):
+    """Обновляет статус оплаты на основе данных из Bitrix."""
+    logger.info("Обновление статусов оплаты из Bitrix")
 
     df_register = df_register.copy()
-    match_condition = df_merged['Новый статус'].notna() & (~df_register['Статус оплаты'].isin(["Оплачено", "Подготовлено"]))
-    df_register.loc[match_condition, 'Статус оплаты'] = df_merged.loc[match_condition, 'Новый статус']
+    match_condition = df_bitrix_lookup['Новый статус'].notna() & (~df_register['Статус оплаты'].isin(["Оплачено", "Подготовлено"]))
+    # where вместо .loc: 'Статус оплаты' категориальный и не знает новых статусов
+    df_register['Статус оплаты'] = df_bitrix_lookup['Новый статус'].where(match_condition, df_register['Статус оплаты'])
 
     updated_count = match_condition.sum()
     if updated_count > 0:
@@ -180,66 +231,39 @@ def update_register_payment_status_bitrix(df_register, df_bitrix):
 
     return df_register
 
-def clean_text_from_stop_words_precise(text, stop_words):
-    if pd.isna(text):
-        return text
-    
-    # Приводим текст к нижнему регистру
-    cleaned_text = str(text).lower()
-    
-    # Создаем паттерн для поиска стоп-слов как отдельных слов
-    pattern = r'\b(?:' + '|'.join(re.escape(word.lower()) for word in stop_words) + r')\b'
-    # Удаляем стоп-слова
-    cleaned_text = re.sub(pattern, '', cleaned_text)
-    
-    # Очищаем лишние пробелы
-    cleaned_text = re.sub(r'\s+', ' ', cleaned_text).strip()
-    
-    return cleaned_text
-
-
-def update_register_id_payment_object_bitrix(df_register, df_bitrix):
+def update_register_id_payment_object_bitrix(df_register, df_bitrix_lookup):
     """Обновляет ID оплаты, если он пуст."""
     logger.info("Обновление ID оплаты ТМЦ Объект из Bitrix")
-    
-    df_bitrix_mapped = df_bitrix[['№ счета', 'Сумма', 'ID', 'Object', 'Things']].copy()
-    df_bitrix_deduplicated = df_bitrix_mapped.drop_duplicates(subset=['№ счета', 'Сумма'])
-
-    df_merged = df_register.merge(
-        df_bitrix_deduplicated,
-        on=['№ счета', 'Сумма'],
-        how='left',
-        suffixes=('', '_bitrix')
-    )
-       
-        # Обновляем Объект
-    match_condition = df_merged['Object'].notna() & df_register['Объект'].isna()
     df_register = df_register.copy()
-    df_register.loc[match_condition, 'Объект'] = df_merged.loc[match_condition, 'Object']
+
+    # Обновляем Объект
+    match_condition = df_bitrix_lookup['Object'].notna() & df_register['Объект'].isna()
+    df_register.loc[match_condition, 'Объект'] = df_bitrix_lookup.loc[match_condition, 'Object']
 
     updated_count = match_condition.sum()
     if updated_count > 0:
         logger.success(f"Обновлено {updated_count} Объектов")
 
     # Обновляем ID
-    match_condition = df_merged['ID'].notna() & df_register['ID_Счет_Bitrix'].isna()
-    df_register = df_register.copy()
-    df_register.loc[match_condition, 'ID_Счет_Bitrix'] = df_merged.loc[match_condition, 'ID']
+    match_condition = df_bitrix_lookup['ID'].notna() & df_register['ID_Счет_Bitrix'].isna()
+    df_register.loc[match_condition, 'ID_Счет_Bitrix'] = df_bitrix_lookup.loc[match_condition, 'ID']
 
     updated_count = match_condition.sum()
     if updated_count > 0:
         logger.success(f"Обновлено {updated_count} ID оплаты")
 
-    # Стоп-слова для удаления
-    stop_words = ['cчет', 'расходы', 'cчета', 'расходов', 'ахч']
-
-    # Применяем очистку к столбцу Object перед обновлением
-    df_merged['Things'] = df_merged['Things'].apply(lambda x: clean_text_from_stop_words_precise(x, stop_words))
+    # Очищаем Things от стоп-слов и лишних пробелов перед обновлением
+    things = (
+        df_bitrix_lookup['Things'].astype("string")
+        .str.lower()
+        .str.replace(_STOP_WORDS_RE, '', regex=True)
+        .str.replace(_SPACES_RE, ' ', regex=True)
+        .str.strip()
+    )
 
     # Обновляем TMC
-    match_condition = df_merged['Things'].notna() & df_register['ТМЦ'].isna()
-    df_register = df_register.copy()
-    df_register.loc[match_condition, 'ТМЦ'] = df_merged.loc[match_condition, 'Things']
+    match_condition = things.notna() & df_register['ТМЦ'].isna()
+    df_register.loc[match_condition, 'ТМЦ'] = things[match_condition]
 
     updated_count = match_condition.sum()
     if updated_count > 0:
@@ -248,24 +272,14 @@ def update_register_id_payment_object_bitrix(df_register, df_bitrix):
     return df_register
 
 
-def update_register_id_task_bitrix(df_register, df_bitrix):
+def update_register_id_task_bitrix(df_register, df_bitrix_lookup):
     """Обновляет № задачи Битрикс, если он пуст."""
     logger.info("Обновление ID задач из Bitrix")
-    
-    df_bitrix_mapped = df_bitrix[['№ счета', 'Сумма', '№ задачи Битрикс']].copy()
-    df_bitrix_deduplicated = df_bitrix_mapped.drop_duplicates(subset=['№ счета', 'Сумма'])
-
-    df_merged = df_register.merge(
-        df_bitrix_deduplicated,
-        on=['№ счета', 'Сумма'],
-        how='left',
-        suffixes=('', '_bitrix')
-    )
+    df_register = df_register.copy()
 
     df_register['№ задачи Битрикс'] = df_register['№ задачи Битрикс'].replace('', pd.NA)
-    df_register = df_register.copy()
-    mask = df_register['№ задачи Битрикс'].isna() & df_merged['№ задачи Битрикс_bitrix'].notna()
-    df_register.loc[mask, '№ задачи Битрикс'] = df_merged.loc[mask, '№ задачи Битрикс_bitrix']
+    mask = df_register['№ задачи Битрикс'].isna() & df_bitrix_lookup['№ задачи Битрикс'].notna()
+    df_register.loc[mask, '№ задачи Битрикс'] = df_bitrix_lookup.loc[mask, '№ задачи Битрикс']
     df_register['№ задачи Битрикс'] = df_register['№ задачи Битрикс'].fillna('')
 
     updated_count = mask.sum()
@@ -276,18 +290,15 @@ def update_register_id_task_bitrix(df_register, df_bitrix):
 
 
 def replace_nan_in_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    """Заменяет NaN на пустую строку в текстовых столбцах (на месте)."""
     logger.info("Очистка NaN значений в DataFrame")
-    df_clean = df.copy()
-    for col in df_clean.columns:
-        if df_clean[col].dtype == 'object':
-            df_clean[col] = df_clean[col].fillna("")
-        else:
-            # df_clean[col] = df_clean[col].fillna(0)
-            pass
+    # Один fillna на весь блок object-столбцов вместо цикла по столбцам
+    object_columns = df.select_dtypes(include='object').columns
+    df[object_columns] = df[object_columns].fillna("")
 
     logger.success("Очистка NaN завершена")
     
-    return df_clean
+    return df
 
 def run_pipeline(directory_path: str) -> str:
     """
@@ -308,10 +319,12 @@ def run_pipeline(directory_path: str) -> str:
         logger.info(f"Обновление реестра: {output_file_path}")
 
         df_register_filled = fill_invoice_numbers_from_bitrix(df_register_clean, df_bitrix_prepared)
-        df_register_updated = update_register_payment_status_bitrix(df_register_filled, df_bitrix_prepared)
-        df_register_updated = update_register_id_payment_object_bitrix(df_register_updated, df_bitrix_prepared)
+        # Номера счетов уже дозаполнены — дальше одно сопоставление на все обновления
+        df_bitrix_lookup = lookup_bitrix_by_invoice(df_register_filled, df_bitrix_prepared)
+        df_register_updated = update_register_payment_status_bitrix(df_register_filled, df_bitrix_lookup)
+        df_register_updated = update_register_id_payment_object_bitrix(df_register_updated, df_bitrix_lookup)
         df_register_updated  = update_date_payment(df_register_updated)
-        df_register_final = update_register_id_task_bitrix(df_register_updated, df_bitrix_prepared)
+        df_register_final = update_register_id_task_bitrix(df_register_updated, df_bitrix_lookup)
 
         df_register_updated = replace_nan_in_dataframe(df_register_final)
 
@@ -332,13 +345,17 @@ def run_pipeline(directory_path: str) -> str:
         return f"❌ Ошибка при обработке: {str(e)}"
 
 
-# Настройка логирования
-logger.remove()
-logger.add("Bitrix_import.log", rotation="10 MB", level="INFO", encoding="utf-8")
-logger.add(lambda msg: print(msg, end=''), level="INFO")
+def setup_logging():
+    """Настраивает логирование (в файл и в stdout). Вызывать только при запуске модуля как скрипта:
+    при импорте из бота и в воркерах пула записи идут в синки бота."""
+    logger.remove()
+    logger.add("Bitrix_import.log", rotation="10 MB", level="INFO", encoding="utf-8")
+    logger.add(lambda msg: print(msg, end=''), level="INFO")
+
 
 # --- Для теста (не обязательно) ---
 if __name__ == "__main__":
+    setup_logging()
     directory_path = r"C:\Users\Юрий Кистенев\Desktop\ACH_manager\record"
 #    directory_path = r"C:\Users\Юрий Кистенев\Desktop\ACH_manager\record"
     result = run_pipeline(directory_path)
@@ -7,10 +7,14 @@
 Добавляет новые счета и возвращает сообщение.
 """
 
+import os
 import re
-import pdfplumber
+import pypdfium2 as pdfium
+import numpy as np
 import pandas as pd
 from datetime import datetime
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from openpyxl import load_workbook
 from openpyxl.utils.dataframe import dataframe_to_rows
@@ -20,10 +24,44 @@ from import_1C import update_excel_file as update_excel_file
 from import_1C import load_ahx_data as load_ahx_data
 from import_1C import prepare_register as prepare_register
 
-# Настройка логирования (в файл и в stdout)
-logger.remove()  # Убираем стандартный handler
-logger.add("invoice_log.log", rotation="10 MB", level="INFO", encoding="utf-8", backtrace=True, diagnose=True)
-logger.add(lambda msg: print(msg, end=''), level="INFO", colorize=True)  # Логи в консоль
+# Регулярные выражения компилируются один раз при импорте модуля
+_AMOUNT_RE = re.compile(r'(?:на сумму)\D*([0-9\s.,]+)', re.IGNORECASE | re.DOTALL)
+_SUPPLIER_PATTERNS = tuple(re.compile(pattern) for pattern in (
+    # 3. ИП полное имя (берём только первое слово после ИП)
+    r'ИП\s+([А-ЯЁ][А-ЯЁа-яё\-]+)',
+    # 4. ИП с инициалами
+    r'ИП\s+([А-ЯЁ][а-яё]+?)\s+[А-ЯЁ]\.\s*[А-ЯЁ]\.',
+    # 5. Полная форма ИП
+    r'Индивидуальный\s+предприниматель\s+([А-ЯЁ][а-яё]+)',
+    # 1. ООО в кавычках (любые кавычки: «», "", '')
+    r'ООО\s*[«"]([^»"]+?)[»"]',
+    # 2. ООО без кавычек — захватываем всё до первого "стоп-слова" или конца строки
+    r'ООО\s+([А-ЯЁ][А-ЯЁа-яё\s\-]+?)(?=\s+(?:ИНН|КПП|Сч\.?|Вид|Наз\.|Очер|Код|Рез|Оплата|Банк|$))'
+))
+_QUOTES_RE = re.compile(r'^["«"]+|["»"]+$')
+_RECIPIENT_RE = re.compile(r'получател', re.IGNORECASE)
+_DOT_DATE_RE = re.compile(r'(\d{1,2})\.(\d{1,2})\.(\d{4})')
+_WORD_DATE_RE = re.compile(r'(\d{1,2})\s*([а-яё]+)\s+(\d{4})\s*(?:г\.?)?', re.IGNORECASE)
+_NUMBER_PART_RE = re.compile(r'(\d+)')
+_PREFIX_RE = re.compile(r'[А-ЯЁ]+')
+# Без этих фраз в прочитанном тексте реквизиты счёта заведомо не извлекутся
+_EARLY_STOP_MARKERS = ('оплату', 'получател', 'на сумму')
+
+# Словарь для перевода названий месяцев в числа
+_MONTH_NAMES = {
+    'января': 1, 'февраля': 2, 'марта': 3, 'апреля': 4,
+    'мая': 5, 'июня': 6, 'июля': 7, 'августа': 8,
+    'сентября': 9, 'октября': 10, 'ноября': 11, 'декабря': 12
+}
+
+
+def setup_logging():
+    """Настраивает логирование (в файл и в stdout). Вызывать только в основном процессе:
+    воркеры пула при spawn заново импортируют модуль и не должны сами открывать invoice_log.log."""
+    logger.remove()  # Убираем стандартный handler
+    # enqueue=True: при fork воркеры наследуют очередь, в файл пишет фоновый поток основного процесса
+    logger.add("invoice_log.log", rotation="10 MB", level="INFO", encoding="utf-8", enqueue=True)
+    logger.add(lambda msg: print(msg, end=''), level="WARNING", colorize=True, enqueue=True)  # В консоль — только предупреждения
 
 
 def get_pdf_files(directory):
@@ -32,7 +70,9 @@ def get_pdf_files(directory):
         dir_path = Path(directory)
         if not dir_path.is_dir():
             raise NotADirectoryError(f"Путь '{directory}' не является директорией.")
-        pdf_files = [f.name for f in dir_path.iterdir() if f.is_file() and f.suffix.lower() == '.pdf']
+        # scandir отдаёт тип записи без отдельного stat() на каждый файл
+        with os.scandir(dir_path) as entries:
+            pdf_files = [entry.name for entry in entries if entry.name.lower().endswith('.pdf') and entry.is_file()]
         logger.info(f"📁 Найдено {len(pdf_files)} PDF-файлов.")
         return pdf_files
     except Exception as e:
@@ -40,19 +80,29 @@ def get_pdf_files(directory):
         return []
 
 
-def process_pdf_files(directory, filename):
-    """Извлекает текст из одного PDF-файла."""
+def process_pdf_files(directory, filename, early_stop=None):
+    """Извлекает текст из одного PDF-файла.
+    early_stop(page_text) -> bool вызывается на каждую новую страницу и позволяет
+    прекратить чтение, когда нужное уже найдено."""
     file_path = Path(directory) / filename
     try:
-        with pdfplumber.open(file_path) as pdf:
-            text = ''
-            for page in pdf.pages:
-                page_text = page.extract_text()
+        # PDFium (C++) извлекает текст значительно быстрее pdfminer
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            # Текст страниц копится в списке и склеивается один раз
+            parts = []
+            for page in pdf:
+                page_text = page.get_textpage().get_text_bounded()
                 if page_text:
-                    text += page_text + "\n"
-            logger.info(f"📄 Успешно извлечён текст из '{filename}' ({len(text)} стр.)")
-            logger.info(f"{text[100:300]}")
-            return text
+                    parts.append(page_text)
+                    if early_stop is not None and early_stop(page_text):
+                        break
+            text = "\n".join(parts)
+        finally:
+            pdf.close()
+        logger.info(f"📄 Успешно извлечён текст из '{filename}' ({len(text)} стр.)")
+        logger.info(f"{text[100:300]}")
+        return text
     except Exception as e:
         logger.error(f"❌ Ошибка при чтении PDF '{filename}': {e}")
         return None
@@ -60,12 +110,15 @@ def process_pdf_files(directory, filename):
 
 def extract_amount(text):
     """Извлекает сумму после фразы 'на сумму'."""
-    match = re.search(r'(?:на сумму)\D*([0-9\s.,]+)', text, re.IGNORECASE | re.DOTALL)
+    match = _AMOUNT_RE.search(text)
     if match:
-        amount_str = match.group(1).strip()
-        cleaned = re.sub(r'[^\d.,]', '', amount_str).replace(',', '.')
-        amount = pd.to_numeric(cleaned, errors='coerce')
-        if pd.notna(amount):
+        # Группа содержит только цифры, пробелы, точки и запятые — достаточно строковых операций
+        cleaned = ''.join(match.group(1).split()).replace(',', '.')
+        try:
+            amount = float(cleaned)
+        except ValueError:
+            amount = None
+        if amount is not None:
             logger.info(f"💰 Извлечена сумма: {amount}")
             return amount
     logger.debug("Сумма не найдена.")
@@ -74,8 +127,7 @@ def extract_amount(text):
 
 def extract_supplier(text: str) -> str:
     """Извлекает поставщика (ООО или ИП)."""
-    lower_text = text.lower()
-    match_start = re.search(r'получател', lower_text)
+    match_start = _RECIPIENT_RE.search(text)
     if not match_start:
         logger.debug("Поставщик не найден.")
         return None 
@@ -83,25 +135,12 @@ def extract_supplier(text: str) -> str:
     # Начинаем поиск в тексте
     search_area = text[match_start.start():]
     logger.debug(f"🔍 Search area: {repr(search_area[:100])}")
-    patterns = [
-        # 3. ИП полное имя (берём только первое слово после ИП)
-        r'ИП\s+([А-ЯЁ][А-ЯЁа-яё\-]+)',
-        # 4. ИП с инициалами
-        r'ИП\s+([А-ЯЁ][а-яё]+?)\s+[А-ЯЁ]\.\s*[А-ЯЁ]\.',
-        # 5. Полная форма ИП
-        r'Индивидуальный\s+предприниматель\s+([А-ЯЁ][а-яё]+)',
-        # 1. ООО в кавычках (любые кавычки: «», "", '')
-        r'ООО\s*[«"]([^»"]+?)[»"]',
-        # 2. ООО без кавычек — захватываем всё до первого "стоп-слова" или конца строки
-        r'ООО\s+([А-ЯЁ][А-ЯЁа-яё\s\-]+?)(?=\s+(?:ИНН|КПП|Сч\.?|Вид|Наз\.|Очер|Код|Рез|Оплата|Банк|$))'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, search_area)
+    for pattern in _SUPPLIER_PATTERNS:
+        match = pattern.search(search_area)
         if match:
             name = match.group(1).strip()
             # Убираем возможные кавычки
-            name = re.sub(r'^["«"]+|["»"]+$', '', name)
+            name = _QUOTES_RE.sub('', name)
             supplier = name.strip()
             logger.info(f"🏭 Поставщик: {supplier}")
             return supplier
@@ -111,15 +150,8 @@ def extract_supplier(text: str) -> str:
 
 
 def get_date_from_line(text: str):
-    # Словарь для перевода названий месяцев в числа
-    month_names = {
-        'января': 1, 'февраля': 2, 'марта': 3, 'апреля': 4,
-        'мая': 5, 'июня': 6, 'июля': 7, 'августа': 8,
-        'сентября': 9, 'октября': 10, 'ноября': 11, 'декабря': 12
-    }
-
     # 1. Поиск даты в формате дд.мм.гггг
-    dot_date_match = re.search(r'(\d{1,2})\.(\d{1,2})\.(\d{4})', text)
+    dot_date_match = _DOT_DATE_RE.search(text)
     if dot_date_match:
         day, month, year = map(int, dot_date_match.groups())
         try:
@@ -130,76 +162,125 @@ def get_date_from_line(text: str):
             pass  # Некорректная дата
 
     # 2. Поиск даты в формате "д (или дд) месяц гггг"
-    word_date_pattern = r'(\d{1,2})\s*([а-яё]+)\s+(\d{4})\s*(?:г\.?)?'
-    matches = re.finditer(word_date_pattern, text, re.IGNORECASE)
+    matches = _WORD_DATE_RE.finditer(text)
     for match in matches:
         day_str, month_word, year_str = match.groups()
         day = int(day_str)
         year = int(year_str)
-        month_word = month_word.lower()
+        month = _MONTH_NAMES.get(month_word.lower())
+        if month is None:
+            continue
 
-        if month_word in month_names:
-            month = month_names[month_word]
-            try:
-                date_part = datetime(year, month, day).date()
-                logger.info(f"📆 Извлечена дата: {date_part}")
-                return date_part
-            except ValueError:
-                continue  # Некорректная дата
+        try:
+            date_part = datetime(year, month, day).date()
+            logger.info(f"📆 Извлечена дата: {date_part}")
+            return date_part
+        except ValueError:
+            continue  # Некорректная дата
 
     # Если ничего не найдено
     return None
 
 
+@lru_cache(maxsize=None)
+def _invoice_number_re(target_phrase):
+    """Номер после «оплату №» в первой строке, где есть ключевая фраза."""
+    return re.compile(
+        rf'^(?=.*{re.escape(target_phrase)}).*?оплату[^\S\n]*№[^\S\n]*(\S+)',
+        re.IGNORECASE | re.MULTILINE
+    )
+
+
 def get_num_invoce(text, target_phrase):
     """Извлекает номер по ключевой фразе."""
-    invoice_number = None
-    for line in text.splitlines():
-        if target_phrase in line.lower():
-            parts = line.split("оплату №")
-            if len(parts) > 1:
-                invoice_number = parts[1].strip().split()[0]
-                break
+    match = _invoice_number_re(target_phrase).search(text)
+    invoice_number = match.group(1) if match else None
     logger.info(f"💰 Извлечен номер: {invoice_number}")
     return invoice_number
 
 
-def extract_invoice_data(pdf_files, directory, target_phrase="счет"):
-    """Извлекает данные из всех PDF-файлов."""
-    invoice_data_list = []
-    for f in pdf_files:
-        try:
-            text = process_pdf_files(directory, f)
-            if not text:
-                logger.warning(f"⚠️ Не удалось извлечь текст из '{f}'. Пропущен.")
-                continue
-
-            invoice_number = get_num_invoce(text, target_phrase)
-            invoice_date = get_date_from_line(text)
-            supplier = extract_supplier(text)
-            amount = extract_amount(text)
-            invoice_data_list.append({
-                    '№ счета': invoice_number,
-                    'Дата счета': invoice_date,
-                    'Поставщик': supplier,
-                    'Сумма': amount
-                })
-
-            logger.info(f"✅ Счёт №{invoice_number} добавлен из '{f}'")
-
-        except Exception as e:
-            logger.error(f"❌ Ошибка при обработке '{f}': {e}")
+def _extract_fields(text, target_phrase):
+    """Извлекает реквизиты счёта из текста (номер без нормализации)."""
+    return {
+        '№ счета': get_num_invoce(text, target_phrase),
+        'Дата счета': get_date_from_line(text),
+        'Поставщик': extract_supplier(text),
+        'Сумма': extract_amount(text)
+    }
+
+
+def _invoice_fields_check(target_phrase="счет"):
+    """Проверка для ранней остановки чтения PDF: все ли реквизиты уже извлекаются.
+    Новая страница просматривается на дешёвые маркеры; сами экстракторы запускаются
+    на прочитанном тексте, только когда все маркеры уже встретились.
+    Возвращает (check, fields): в fields — реквизиты, извлечённые на всём прочитанном тексте,
+    либо пусто, если на последней странице экстракторы не запускались."""
+    pages = []
+    seen_markers = set()
+    fields = {}
+
+    def check(page_text):
+        pages.append(page_text)
+        fields.clear()
+        lower_page = page_text.lower()
+        seen_markers.update(marker for marker in _EARLY_STOP_MARKERS if marker in lower_page)
+        if len(seen_markers) < len(_EARLY_STOP_MARKERS):
+            return False
+
+        fields.update(_extract_fields("\n".join(pages), target_phrase))
+        return all(value is not None for value in fields.values())
+
+    return check, fields
+
+
+def _process_one(file_path, target_phrase="счет"):
+    """Извлекает данные счёта из одного PDF-файла (выполняется в отдельном процессе)."""
+    try:
+        # Реквизиты обычно на первой странице — приложения и условия не читаем
+        check, fields = _invoice_fields_check(target_phrase)
+        text = process_pdf_files(file_path.parent, file_path.name, early_stop=check)
+        if not text:
+            return None
+
+        # Проверка уже извлекла реквизиты из того же текста — повторно не разбираем
+        invoice_data = dict(fields) or _extract_fields(text, target_phrase)
+        # Номер нормализуется сразу: нижний регистр, без ведущих нулей
+        invoice_data['№ счета'] = (invoice_data['№ счета'] or '').lower().lstrip('0')
+        return invoice_data
+    except Exception as e:
+        logger.error(f"❌ Ошибка при обработке '{file_path.name}': {e}")
+        return None
+
+
+def extract_invoice_data(pdf_files, directory, target_phrase="счет", max_workers=None):
+    """Извлекает данные из всех PDF-файлов (по умолчанию по процессу на ядро).
+    max_workers=1 — разбор в текущем процессе, без своего пула."""
+    # Значения копятся по столбцам — DataFrame строится из готовых списков
+    invoice_columns = {'№ счета': [], 'Дата счета': [], 'Поставщик': [], 'Сумма': []}
+    file_paths = [Path(directory) / f for f in pdf_files]
+    max_workers = min(len(file_paths), max_workers or os.cpu_count() or 1) or 1
+    process_one = partial(_process_one, target_phrase=target_phrase)
+    if max_workers == 1:
+        results = list(map(process_one, file_paths))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(process_one, file_paths, chunksize=4))
+
+    for f, invoice_data in zip(pdf_files, results):
+        if invoice_data is None:
+            logger.warning(f"⚠️ Не удалось извлечь текст из '{f}'. Пропущен.")
+            continue
+
+        for column, values in invoice_columns.items():
+            values.append(invoice_data[column])
+        logger.info(f"✅ Счёт №{invoice_data['№ счета']} добавлен из '{f}'")
 
     
-    invoice_df = pd.DataFrame(invoice_data_list, columns=['№ счета', 'Дата счета', 'Поставщик', 'Сумма'])
+    invoice_df = pd.DataFrame(invoice_columns)
     invoice_df['Дата счета'] = pd.to_datetime(invoice_df['Дата счета'], errors='coerce')
     invoice_df['Контроль оплаты'] = invoice_df['Дата счета'] + pd.Timedelta(days=21)
-    invoice_df['№ счета'] = invoice_df['№ счета'].pipe(
-        lambda series: series.fillna('')
-        .astype("string")
-        .str.lower()
-        .str.lstrip('0')
-    )
+    invoice_df['№ счета'] = invoice_df['№ счета'].astype("string")
+    invoice_df['Поставщик'] = invoice_df['Поставщик'].astype('category')
 
     invoice_df['Сумма'] = pd.to_numeric(invoice_df['Сумма'], errors='coerce').round(2)
 
@@ -217,44 +298,41 @@ def update_register_with_new_invoices(df_register, df_invoice_reg):
     try:
         # 1. Объединяем основной датафрейм с новыми строками
         df_export_unique = df_invoice_reg.drop_duplicates(subset=['№ счета', 'Сумма'])
-        df_register_keep = df_register[['№ счета', 'Сумма']]
-        
-        df_merged = df_export_unique.merge(
-            df_register_keep,
-            on=['№ счета', 'Сумма'],
-            how='left',
-#            suffixes=('', '_merge'),
-            indicator=True
-            )
-        new_rows = df_merged[df_merged['_merge'] == 'left_only'].drop('_merge', axis=1)
+        # Новые — те пары (№ счета, Сумма), которых ещё нет в реестре.
+        # Ключи обеих сторон приводятся к одним типам, чтобы не хэшировать object
+        key_dtypes = {'№ счета': 'string', 'Сумма': 'float64'}
+        register_keys = pd.MultiIndex.from_frame(df_register[['№ счета', 'Сумма']].astype(key_dtypes))
+        invoice_keys = pd.MultiIndex.from_frame(df_export_unique[['№ счета', 'Сумма']].astype(key_dtypes))
+        new_rows = df_export_unique[~invoice_keys.isin(register_keys)]
         logger.info(f"✅ Добавлено {new_rows} новых записей в реестр.")
+
+        # 2. Номера "Ю-..." считаем по текущему реестру, до объединения
+        blue_numbers = df_register['№ синей накладной']
+        number_part = blue_numbers.str.extract(_NUMBER_PART_RE, expand=False).astype('Int64')
+        # 3. Находим максимальный номер
+        last_number = number_part.max()
+        start_num = int(last_number) + 1 if pd.notna(last_number) else 1
+        # 4. Генерируем номера: сначала пропуски в реестре, затем новые счета
+        missing = blue_numbers.isna()
+        missing_count = missing.sum()
+        nan_count = missing_count + len(new_rows)
+        last_prefix = blue_numbers.str.findall(_PREFIX_RE).str[-1].loc[0]
+        new_numbers = np.char.add(f'{last_prefix}-', np.arange(start_num, start_num + nan_count).astype(str)).astype(object)
+        # 5. Заполняем пропущенные значения и добавляем новые строки уже с номерами
+        df_register.loc[missing, '№ синей накладной'] = new_numbers[:missing_count]
+        new_rows = new_rows.assign(**{'№ синей накладной': new_numbers[missing_count:]})
         df_register = pd.concat([df_register, new_rows], ignore_index=True)
 
         logger.info(f"✅ Добавлено {len(new_rows)} новых записей в реестр.")
-        # 2. Приводим даты к формату datetime
-#        df_register['Дата счета'] = pd.to_datetime(df_register['Дата счета'], errors='coerce')
-        # 3. Извлекаем числа из существующих номеров "Ю-..."
-        df_register['number_part'] = df_register['№ синей накладной'].str.extract(r'(\d+)')[0]
-        df_register['number_part'] = pd.to_numeric(df_register['number_part'], errors='coerce')
-        # 4. Находим максимальный номер
-        last_number = df_register['number_part'].max()
-        start_num = int(last_number) + 1 if pd.notna(last_number) else 1
-        # 5. Генерируем новые номера для NaN
-        nan_count = df_register['№ синей накладной'].isna().sum()
-        last_prefix = df_register['№ синей накладной'].str.findall(r'[А-ЯЁ]+').str[-1].loc[0]
-        new_numbers = [f'{last_prefix}-{i}' for i in range(start_num, start_num + nan_count)]
-        # 6. Заполняем пропущенные значения
-        df_register.loc[df_register['№ синей накладной'].isna(), '№ синей накладной'] = new_numbers
-        # 7. Убираем временный столбец
-        df_register.drop(columns=['number_part'], inplace=True)
         return df_register
     except Exception as e:
         logger.exception(f"❌ Ошибка при обновлении реестра: {e}")
         return "❌ Ошибка при обновлении реестра"
 
-def run_pipeline(directory_path: str) -> str:
+def run_pipeline(directory_path: str, max_workers=None) -> str:
     """
     Основная функция — запускает пайплайн.
+    max_workers — число процессов для разбора PDF (1 — без собственного пула).
     Возвращает строку-результат для Telegram-бота.
     """
     try:
@@ -272,7 +350,7 @@ def run_pipeline(directory_path: str) -> str:
         logger.info(f"Обновление реестра: {output_file_path}")
 
         # Шаг 3: Извлечение данных из PDF
-        df_invoice_reg = extract_invoice_data(pdf_files, directory_path, "счет")
+        df_invoice_reg = extract_invoice_data(pdf_files, directory_path, "счет", max_workers)
         if df_invoice_reg.empty:
             return "ℹ️ Новых счетов для добавления не найдено."
 
@@ -295,6 +373,7 @@ def run_pipeline(directory_path: str) -> str:
 
 # --- Для теста (не обязательно) ---
 if __name__ == "__main__":
+    setup_logging()
     test_path = r"C:\Users\Юрий Кистенев\Desktop\ACH_manager\record"
     result = run_pipeline(test_path)
     print(result)
\ No newline at end of file